@@ -1,11 +1,19 @@
 # backend/data.py
-from dataclasses import dataclass
-from typing import Dict, List
-
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import math
+import os
+import pickle
+
+import numpy as np
+import orjson
 import osmnx as ox
+from scipy.spatial import cKDTree
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Node:
     id: str
     name: str
@@ -14,19 +22,119 @@ class Node:
     elevation: float  # meters (we'll keep 0 for now)
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Edge:
     u: str
     v: str
     distance_m: float
     road_type: str       # "path", "residential", "main_road"
     elevation_gain_m: float  # positive if uphill u -> v
+    key: Tuple[str, str]     # undirected key (min(u, v), max(u, v)), shared by both directions
+
+
+# road_type -> small int code used by the routing arrays (GraphHot.road_type_code)
+ROAD_TYPES: Tuple[str, ...] = ("path", "residential", "main_road")
+
+
+@dataclass
+class GraphHot:
+    """
+    Routing view of the graph: CSR arrays only, indexed by node position in
+    `ids`. The edges leaving node i are indptr[i]:indptr[i + 1].
+    Arrays are quantized (float32 / int16) to halve memory traffic.
+    """
+    ids: List[str] = field(default_factory=list)
+    id_to_idx: Dict[str, int] = field(default_factory=dict)
+    indptr: np.ndarray = field(default_factory=lambda: np.zeros(1, dtype=np.int32))
+    neighbors: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int32))
+    weights: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.float32))
+    # same weights as integer centimeters (>= 1), for the bucket-queue searches
+    weights_cm: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.uint32))
+    # weights_cm.max(), kept so searches do not rescan every edge
+    max_weight_cm: int = 0
+    # elevation gain along each edge in decimeters
+    elevation_gain_dm: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int16))
+    # index into ROAD_TYPES
+    road_type_code: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int8))
+    # dense id per undirected edge: (u, v) and (v, u) share it
+    edge_key_id: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int32))
+
+
+@dataclass
+class SnapSegments:
+    """
+    Undirected graph segments in local x/y meters, as flat arrays
+    (same order as the /graph payload). Used by /route/snap.
+    """
+    x1: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.float32))
+    y1: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.float32))
+    vx: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.float32))    # x2 - x1
+    vy: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.float32))    # y2 - y1
+    len2: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.float32))  # squared segment length
+    # segments are cut into pieces of at most _SNAP_PIECE_M; KD-tree over the
+    # piece midpoints, piece_seg[p] = segment of piece p. A point within r of
+    # a segment is within r + max_half_len of some piece midpoint, so a ball
+    # query finds every candidate while long edges stay cheap to query
+    mid_tree: Optional[cKDTree] = None
+    piece_seg: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int32))
+    max_half_len: float = 0.0
 
 
 @dataclass
-class Graph:
+class GraphBuild:
+    """
+    Node objects (full float precision) plus the serialization / snapping
+    data built from the graph. Edges only live in `hot`; routing only
+    uses `hot`.
+    """
     nodes: Dict[str, Node]
-    adjacency: Dict[str, List[Edge]]
+    hot: GraphHot = field(default_factory=GraphHot)
+    # origin of the local x/y projection (see latlon_to_xy)
+    center_lat: float = 0.0
+    center_lon: float = 0.0
+    # KD-tree over projected node x/y (same order as hot.ids)
+    kdtree: Optional[cKDTree] = None
+    # segment arrays for snapping, derived from the projected node x/y
+    snap: SnapSegments = field(default_factory=SnapSegments)
+    # pre-serialized /graph payload: [[lat1, lon1, lat2, lon2, road_type], ...]
+    graph_json: bytes = b"[]"
+
+
+def latlon_to_xy(lat, lon, lat0: float, lon0: float):
+    """
+    Very simple local projection: lat/lon -> x/y in meters around (lat0, lon0).
+    Good enough at city scale. Works on floats and on NumPy arrays.
+    """
+    # meters per degree
+    k_lat = 111_320.0
+    k_lon = 111_320.0 * math.cos(math.radians(lat0))
+
+    x = (lon - lon0) * k_lon
+    y = (lat - lat0) * k_lat
+    return x, y
+
+
+def xy_to_latlon(x, y, lat0: float, lon0: float):
+    k_lat = 111_320.0
+    k_lon = 111_320.0 * math.cos(math.radians(lat0))
+
+    lat = y / k_lat + lat0
+    lon = x / k_lon + lon0
+    return lat, lon
+
+
+# OSM 'highway' tag -> our simple categories
+_HIGHWAY_CATEGORY: Dict[str, str] = {
+    "motorway": "main_road",
+    "trunk": "main_road",
+    "primary": "main_road",
+    "secondary": "residential",
+    "tertiary": "residential",
+    "unclassified": "residential",
+    "residential": "residential",
+    "living_street": "residential",
+    "service": "residential",
+}
 
 
 def _classify_road_type(highway) -> str:
@@ -36,19 +144,8 @@ def _classify_road_type(highway) -> str:
     if isinstance(highway, list):
         highway = highway[0]
 
-    if highway in {"motorway", "trunk", "primary"}:
-        return "main_road"
-    if highway in {
-        "secondary",
-        "tertiary",
-        "unclassified",
-        "residential",
-        "living_street",
-        "service",
-    }:
-        return "residential"
     # everything else we treat as "path" (footway, cycleway, track, steps...)
-    return "path"
+    return _HIGHWAY_CATEGORY.get(highway, "path")
 
 
 def _add_undirected_edge(
@@ -63,19 +160,135 @@ def _add_undirected_edge(
     elev_gain_uv = max(elev_v - elev_u, 0.0)
     elev_gain_vu = max(elev_u - elev_v, 0.0)
 
-    adjacency.setdefault(u, []).append(
-        Edge(u=u, v=v, distance_m=distance_m,
-             road_type=road_type, elevation_gain_m=elev_gain_uv)
+    key = (u, v) if u < v else (v, u)
+    e_uv = Edge(u=u, v=v, distance_m=distance_m,
+                road_type=road_type, elevation_gain_m=elev_gain_uv, key=key)
+    e_vu = Edge(u=v, v=u, distance_m=distance_m,
+                road_type=road_type, elevation_gain_m=elev_gain_vu, key=key)
+
+    adjacency.setdefault(u, []).append(e_uv)
+    adjacency.setdefault(v, []).append(e_vu)
+
+
+def _build_csr(
+    ids: List[str],
+    adjacency: Dict[str, List[Edge]],
+) -> GraphHot:
+    """
+    Flatten the adjacency lists into CSR arrays (same edge order as `adjacency`).
+    """
+    id_to_idx = {node_id: i for i, node_id in enumerate(ids)}
+    edge_key_ids: Dict[Tuple[str, str], int] = {}
+    road_type_codes = {road_type: i for i, road_type in enumerate(ROAD_TYPES)}
+
+    n_edges = sum(len(edges) for edges in adjacency.values())
+    indptr = np.zeros(len(ids) + 1, dtype=np.int32)
+    neighbors = np.empty(n_edges, dtype=np.int32)
+    weights = np.empty(n_edges, dtype=np.float32)
+    weights_cm = np.empty(n_edges, dtype=np.uint32)
+    elevation_gain_dm = np.empty(n_edges, dtype=np.int16)
+    road_type_code = np.empty(n_edges, dtype=np.int8)
+    edge_key_id = np.empty(n_edges, dtype=np.int32)
+
+    pos = 0
+    for i, node_id in enumerate(ids):
+        for e in adjacency.get(node_id, []):
+            neighbors[pos] = id_to_idx[e.v]
+            weights[pos] = e.distance_m
+            weights_cm[pos] = max(1, round(e.distance_m * 100))
+            # int16 decimeters: up to ~3.2 km of climb per edge
+            elevation_gain_dm[pos] = min(round(e.elevation_gain_m * 10), 32767)
+            road_type_code[pos] = road_type_codes[e.road_type]
+            edge_key_id[pos] = edge_key_ids.setdefault(e.key, len(edge_key_ids))
+            pos += 1
+        indptr[i + 1] = pos
+
+    return GraphHot(
+        ids=ids,
+        id_to_idx=id_to_idx,
+        indptr=indptr,
+        neighbors=neighbors,
+        weights=weights,
+        weights_cm=weights_cm,
+        max_weight_cm=int(weights_cm.max(initial=0)),
+        elevation_gain_dm=elevation_gain_dm,
+        road_type_code=road_type_code,
+        edge_key_id=edge_key_id,
     )
-    adjacency.setdefault(v, []).append(
-        Edge(u=v, v=u, distance_m=distance_m,
-             road_type=road_type, elevation_gain_m=elev_gain_vu)
+
+
+def _build_segments(
+    adjacency: Dict[str, List[Edge]],
+    id_to_idx: Dict[str, int],
+) -> Tuple[List[Edge], np.ndarray]:
+    """
+    Deduplicate undirected edges once.
+    Returns (undirected_edges, segment_nodes).
+    """
+    undirected_edges: List[Edge] = []
+    seg_u: List[int] = []
+    seg_v: List[int] = []
+    seen = set()
+
+    for u, edges in adjacency.items():
+        for e in edges:
+            # undirected: (u,v) and (v,u) are the same, so we dedupe
+            if e.key in seen:
+                continue
+            seen.add(e.key)
+
+            seg_u.append(id_to_idx[e.u])
+            seg_v.append(id_to_idx[e.v])
+            undirected_edges.append(e)
+
+    segment_nodes = np.column_stack([seg_u, seg_v]).astype(np.int32).reshape(-1, 2)
+
+    return undirected_edges, segment_nodes
+
+
+# max length of the pieces segments are cut into for the snap KD-tree
+_SNAP_PIECE_M = 50.0
+
+
+def _build_snap_segments(
+    node_x: np.ndarray,
+    node_y: np.ndarray,
+    segment_nodes: np.ndarray,
+) -> SnapSegments:
+    """
+    Segment arrays for snapping: endpoints are gathered from the projected
+    node x/y, so nothing is re-projected per request.
+    """
+    i, j = segment_nodes[:, 0], segment_nodes[:, 1]
+    x1, y1 = node_x[i], node_y[i]
+    x2, y2 = node_x[j], node_y[j]
+    vx, vy = x2 - x1, y2 - y1
+
+    # piece midpoints / half lengths in float64 so the ball-query bound holds exactly
+    seg_len = np.hypot(vx.astype(np.float64), vy)
+    n_pieces = np.maximum(np.ceil(seg_len / _SNAP_PIECE_M), 1).astype(np.int64)
+    piece_seg = np.repeat(np.arange(len(seg_len), dtype=np.int32), n_pieces)
+    first_piece = np.cumsum(n_pieces) - n_pieces
+    k = np.arange(len(piece_seg)) - first_piece[piece_seg]
+    t = (k + 0.5) / n_pieces[piece_seg]
+    mid = np.column_stack([
+        x1[piece_seg] + t * vx[piece_seg].astype(np.float64),
+        y1[piece_seg] + t * vy[piece_seg].astype(np.float64),
+    ])
+    half_len = seg_len / (2 * n_pieces)
+
+    return SnapSegments(
+        x1=x1, y1=y1,
+        vx=vx, vy=vy, len2=vx * vx + vy * vy,
+        mid_tree=cKDTree(mid) if len(mid) else None,
+        piece_seg=piece_seg,
+        max_half_len=float(half_len.max(initial=0.0)),
     )
 
 
 # backend/data.py  (keep the dataclasses and helpers above as they are)
 
-def build_graph(center_lat: float, center_lon: float, dist_m: int = 1200) -> Graph:
+def _build_graph_from_osm(center_lat: float, center_lon: float, dist_m: int) -> GraphBuild:
     """
     Build a graph from OpenStreetMap around a given center point.
     """
@@ -157,10 +370,101 @@ def build_graph(center_lat: float, center_lon: float, dist_m: int = 1200) -> Gra
         f"Built graph with {len(nodes)} nodes and "
         f"{sum(len(v) for v in adjacency.values())} directed edges."
     )
-    return Graph(nodes=nodes, adjacency=adjacency)
+    ids = list(nodes.keys())
+    lats = np.fromiter((nodes[i].lat for i in ids), dtype=np.float64, count=len(ids))
+    lons = np.fromiter((nodes[i].lon for i in ids), dtype=np.float64, count=len(ids))
+
+    # project from full-precision degrees; cKDTree works in float64 anyway,
+    # the stored float32 meters are sub-millimeter here
+    xs, ys = latlon_to_xy(lats, lons, center_lat, center_lon)
+    kdtree = cKDTree(np.column_stack([xs, ys])) if ids else None
+    xs, ys = xs.astype(np.float32), ys.astype(np.float32)
+
+    hot = _build_csr(ids, adjacency)
+    undirected_edges, segment_nodes = _build_segments(
+        adjacency, hot.id_to_idx
+    )
+    graph_json = orjson.dumps([
+        [nodes[e.u].lat, nodes[e.u].lon, nodes[e.v].lat, nodes[e.v].lon, e.road_type]
+        for e in undirected_edges
+    ])
+
+    return GraphBuild(
+        nodes=nodes,
+        hot=hot,
+        center_lat=center_lat,
+        center_lon=center_lon,
+        kdtree=kdtree,
+        snap=_build_snap_segments(xs, ys, segment_nodes),
+        graph_json=graph_json,
+    )
 
 
-def build_default_graph() -> Graph:
+# bump when the GraphBuild / GraphHot layout changes so old pickles are not loaded
+_GRAPH_CACHE_VERSION = 11
+# how many built graphs to keep in memory
+_GRAPH_LRU_SIZE = 4
+_graph_lru: "OrderedDict[Tuple[float, float, int], GraphBuild]" = OrderedDict()
+
+
+def _fnv1a_64(text: str) -> str:
+    """
+    64-bit FNV-1a hash of `text` as 16 hex chars (stable across runs,
+    unlike hash()).
+    """
+    h = 0xCBF29CE484222325
+    for byte in text.encode("utf-8"):
+        h ^= byte
+        h = (h * 0x100000001B3) & 0xFFFFFFFFFFFFFFFF
+    return f"{h:016x}"
+
+
+def _graph_cache_path(key: Tuple[float, float, int]) -> Path:
+    # same folder osmnx uses for its Overpass responses
+    name = _fnv1a_64(f"v{_GRAPH_CACHE_VERSION}:{key[0]}:{key[1]}:{key[2]}")
+    return Path(ox.settings.cache_folder) / f"{name}.pkl"
+
+
+def build_graph(center_lat: float, center_lon: float, dist_m: int = 1200) -> GraphBuild:
+    """
+    Graph around a given center point, cached in memory (LRU) and on disk.
+    The cache key rounds the center to 4 decimals (~10 m).
+    """
+    key = (round(center_lat, 4), round(center_lon, 4), int(dist_m))
+
+    graph = _graph_lru.get(key)
+    if graph is not None:
+        _graph_lru.move_to_end(key)
+        return graph
+
+    path = _graph_cache_path(key)
+    try:
+        with path.open("rb") as f:
+            graph = pickle.load(f)
+        print(f"Loaded graph from {path}")
+    except FileNotFoundError:
+        pass
+    except Exception as exc:  # stale or corrupt pickle: rebuild it
+        print(f"Ignoring graph cache {path}: {exc!r}")
+
+    if graph is None:
+        graph = _build_graph_from_osm(center_lat, center_lon, dist_m)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(".tmp")
+            with tmp.open("wb") as f:
+                pickle.dump(graph, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except OSError as exc:
+            print(f"Could not write graph cache {path}: {exc!r}")
+
+    _graph_lru[key] = graph
+    if len(_graph_lru) > _GRAPH_LRU_SIZE:
+        _graph_lru.popitem(last=False)
+    return graph
+
+
+def build_default_graph() -> GraphBuild:
     """
     Default graph around Turku (used at startup).
     """
@@ -169,20 +473,14 @@ def build_default_graph() -> Graph:
     return build_graph(CENTER_LAT, CENTER_LON, dist_m=1200)
 
 
-def find_nearest_node_id(graph: Graph, lat: float, lon: float) -> str:
+def find_nearest_node_id(graph: GraphBuild, lat: float, lon: float) -> str:
     """
-    Find the node id in our Graph whose (lat, lon) is closest to the given point.
+    Find the node id in our graph whose (lat, lon) is closest to the given point.
     """
-    best_id = None
-    best_d2 = float("inf")
-
-    for node_id, node in graph.nodes.items():
-        d2 = (node.lat - lat) ** 2 + (node.lon - lon) ** 2
-        if d2 < best_d2:
-            best_d2 = d2
-            best_id = node_id
-
-    if best_id is None:
+    if graph.kdtree is None:
         raise RuntimeError("No nodes in graph")
-    return best_id
+
+    xy = latlon_to_xy(lat, lon, graph.center_lat, graph.center_lon)
+    _, idx = graph.kdtree.query(xy, k=1)
+    return graph.hot.ids[int(idx)]
 
@@ -4,6 +4,8 @@ from pydantic import BaseModel
 from typing import List
 import math
 
+import numpy as np
+
 router = APIRouter()
 
 
@@ -37,6 +39,22 @@ def _haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
     return R * c
 
 
+def _haversine_path_m(lats: np.ndarray, lons: np.ndarray) -> float:
+    """
+    Total great-circle length of a polyline in meters.
+    Same formula as _haversine_m, evaluated for all consecutive pairs at once.
+    """
+    R = 6371000.0  # Earth radius in meters
+
+    phi = np.radians(lats)
+    dphi = np.diff(phi)
+    dlambda = np.diff(np.radians(lons))
+
+    a = np.sin(dphi / 2) ** 2 + np.cos(phi[:-1]) * np.cos(phi[1:]) * np.sin(dlambda / 2) ** 2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return float((R * c).sum())
+
+
 @router.post("/route/adjust", response_model=EditableRouteResponse)
 def adjust_route(payload: EditableRouteRequest):
     """
@@ -51,8 +69,8 @@ def adjust_route(payload: EditableRouteRequest):
     if len(pts) < 2:
         raise HTTPException(status_code=400, detail="Route must contain at least 2 points.")
 
-    total_m = 0.0
-    for p1, p2 in zip(pts[:-1], pts[1:]):
-        total_m += _haversine_m(p1.lat, p1.lon, p2.lat, p2.lon)
+    lats = np.fromiter((p.lat for p in pts), dtype=np.float64, count=len(pts))
+    lons = np.fromiter((p.lon for p in pts), dtype=np.float64, count=len(pts))
+    total_m = _haversine_path_m(lats, lons)
 
     return EditableRouteResponse(distance_km=total_m / 1000.0)
@@ -1,14 +1,23 @@
 # backend/main.py
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from .edit import router as edit_router  
 
-from typing import List, Tuple, Optional
+from typing import List
 import math
 
+import numpy as np
 
-from .data import build_default_graph, build_graph, find_nearest_node_id
+
+from .data import (
+    GraphBuild,
+    build_default_graph,
+    build_graph,
+    find_nearest_node_id,
+    latlon_to_xy,
+    xy_to_latlon,
+)
 from .routing import find_best_loop
 
 
@@ -68,23 +77,27 @@ def get_route(
 
     global graph, graph_center_lat, graph_center_lon
 
+    # work on one graph for the whole request, even if another /route swaps it
+    g = graph
+
     # If user gave explicit coordinates and they are far from current graph center,
     # rebuild the graph around that pinned location.
     if start_lat is not None and start_lon is not None:
         d2 = (start_lat - graph_center_lat) ** 2 + (start_lon - graph_center_lon) ** 2
         # threshold ~0.03 degrees ≈ a few km
         if d2 > (0.03 ** 2):
-            graph = build_graph(start_lat, start_lon, dist_m=2000)
+            g = build_graph(start_lat, start_lon, dist_m=2000)
+            graph = g
             graph_center_lat = start_lat
             graph_center_lon = start_lon
 
-        effective_start = find_nearest_node_id(graph, start_lat, start_lon)
+        effective_start = find_nearest_node_id(g, start_lat, start_lon)
     else:
         # no coordinates: just use the provided start_node_id in the current graph
         effective_start = start_node_id
 
     result = find_best_loop(
-        graph=graph,
+        graph=g.hot,
         start=effective_start,
         d_min_m=d_min_m,
         d_max_m=d_max_m,
@@ -109,7 +122,7 @@ def get_route(
 
     coords: List[Coordinate] = []
     for node_id in result.nodes:
-        node = graph.nodes[node_id]
+        node = g.nodes[node_id]
         coords.append(Coordinate(lat=node.lat, lon=node.lon, name=node.name))
 
     return RouteResponse(
@@ -118,44 +131,17 @@ def get_route(
         node_ids=result.nodes,
         coordinates=coords,
     )
-class GraphEdge(BaseModel):
-    lat1: float
-    lon1: float
-    lat2: float
-    lon2: float
-    road_type: str
-
-@app.get("/graph", response_model=List[GraphEdge])
-def get_graph_edges():
+
+@app.get("/graph")
+def get_graph_edges() -> Response:
     """
     Return all edges in the current graph as simple segments
     so the frontend can style them by road_type.
+
+    Each segment is [lat1, lon1, lat2, lon2, road_type]; the JSON is
+    built once per graph in build_graph.
     """
-    segments: List[GraphEdge] = []
-    seen = set()  # to avoid duplicating undirected edges
-
-    for u, edges in graph.adjacency.items():
-        for e in edges:
-            # undirected: (u,v) and (v,u) are the same, so we dedupe
-            key = tuple(sorted((e.u, e.v)))
-            if key in seen:
-                continue
-            seen.add(key)
-
-            n1 = graph.nodes[e.u]
-            n2 = graph.nodes[e.v]
-
-            segments.append(
-                GraphEdge(
-                    lat1=n1.lat,
-                    lon1=n1.lon,
-                    lat2=n2.lat,
-                    lon2=n2.lon,
-                    road_type=e.road_type,
-                )
-            )
-
-    return segments
+    return Response(content=graph.graph_json, media_type="application/json")
 
 class SnapPoint(BaseModel):
     lat: float
@@ -172,87 +158,14 @@ class SnapManyResponse(BaseModel):
 
 
 
-def _latlon_to_xy(lat: float, lon: float, lat0: float, lon0: float) -> Tuple[float, float]:
-    """
-    Very simple local projection: lat/lon -> x/y in meters around (lat0, lon0).
-    Good enough at city scale.
-    """
-    # meters per degree
-    k_lat = 111_320.0
-    k_lon = 111_320.0 * math.cos(math.radians(lat0))
-
-    x = (lon - lon0) * k_lon
-    y = (lat - lat0) * k_lat
-    return x, y
-
-
-def _xy_to_latlon(x: float, y: float, lat0: float, lon0: float) -> Tuple[float, float]:
-    k_lat = 111_320.0
-    k_lon = 111_320.0 * math.cos(math.radians(lat0))
-
-    lat = y / k_lat + lat0
-    lon = x / k_lon + lon0
-    return lat, lon
-
-
-def _project_point_to_segment(
-    px: float, py: float,
-    x1: float, y1: float,
-    x2: float, y2: float,
-) -> Tuple[float, float, float]:
-    """
-    Project point P onto segment A(x1,y1)-B(x2,y2) in x/y meters.
-    Returns (proj_x, proj_y, distance_m).
-    """
-    vx = x2 - x1
-    vy = y2 - y1
-    wx = px - x1
-    wy = py - y1
-
-    seg_len2 = vx * vx + vy * vy
-    if seg_len2 == 0.0:
-        # A and B are the same point
-        return x1, y1, math.dist((px, py), (x1, y1))
-
-    t = (vx * wx + vy * wy) / seg_len2
-    t = max(0.0, min(1.0, t))  # clamp to segment
-
-    proj_x = x1 + t * vx
-    proj_y = y1 + t * vy
-
-    dist = math.dist((px, py), (proj_x, proj_y))
-    return proj_x, proj_y, dist
-
-
-def _build_segments_for_snap():
-    """
-    Build a list of segments (lat1, lon1, lat2, lon2) from the current graph.
-    Avoids double-counting undirected edges.
-    """
-    global graph
-    segments: List[Tuple[float, float, float, float]] = []
-    seen = set()
-
-    for u, edges in graph.adjacency.items():
-        for e in edges:
-            key = tuple(sorted((e.u, e.v)))
-            if key in seen:
-                continue
-            seen.add(key)
-
-            n1 = graph.nodes[e.u]
-            n2 = graph.nodes[e.v]
-            segments.append((n1.lat, n1.lon, n2.lat, n2.lon))
-
-    return segments
-
-
-def _densify_points(points: List[SnapPoint], max_step_m: float = 25.0) -> List[SnapPoint]:
+def _densify_points(
+    g: GraphBuild, points: List[SnapPoint], max_step_m: float = 25.0
+) -> List[SnapPoint]:
     """
     Insert extra points between the user’s edited points so snapping
     can follow corners instead of cutting across blocks.
     """
-    global graph_center_lat, graph_center_lon
+    lat0, lon0 = g.center_lat, g.center_lon
 
     if len(points) < 2:
         return points
@@ -265,8 +178,8 @@ def _densify_points(points: List[SnapPoint], max_step_m: float = 25.0) -> List[S
         densified.append(p1)
 
         # work in local x/y meters
-        x1, y1 = _latlon_to_xy(p1.lat, p1.lon, graph_center_lat, graph_center_lon)
-        x2, y2 = _latlon_to_xy(p2.lat, p2.lon, graph_center_lat, graph_center_lon)
+        x1, y1 = latlon_to_xy(p1.lat, p1.lon, lat0, lon0)
+        x2, y2 = latlon_to_xy(p2.lat, p2.lon, lat0, lon0)
         dx = x2 - x1
         dy = y2 - y1
         seg_len = math.hypot(dx, dy)
@@ -278,7 +191,7 @@ def _densify_points(points: List[SnapPoint], max_step_m: float = 25.0) -> List[S
                 t = k / (n + 1)
                 xi = x1 + dx * t
                 yi = y1 + dy * t
-                lat_i, lon_i = _xy_to_latlon(xi, yi, graph_center_lat, graph_center_lon)
+                lat_i, lon_i = xy_to_latlon(xi, yi, lat0, lon0)
                 densified.append(SnapPoint(lat=lat_i, lon=lon_i))
 
     densified.append(points[-1])
@@ -291,12 +204,16 @@ def snap_route(req: SnapManyRequest):
     Geometric snapping:
 
     1. Densify the edited polyline (add points every ~25 m).
-    2. For each point, project to nearest road segment in the graph.
+    2. For each point, project to nearest road segment in the graph
+       (candidates from a ball query on segment piece midpoints, exact
+       within MAX_SNAP_DIST_M).
     3. Keep the very first and very last coordinates exactly as user edited.
     """
-    global graph, graph_center_lat, graph_center_lon
+    # read the global once: /route may swap in a new graph concurrently
+    g = graph
+    lat0, lon0 = g.center_lat, g.center_lon
 
-    if not graph.nodes:
+    if not g.nodes:
         # fallback: nothing to do
         return SnapManyResponse(points=req.points)
 
@@ -305,41 +222,65 @@ def snap_route(req: SnapManyRequest):
         return SnapManyResponse(points=[])
 
     # 1) Densify polyline so corners follow streets instead of cutting through blocks
-    dense_pts = _densify_points(pts, max_step_m=25.0)
+    dense_pts = _densify_points(g, pts, max_step_m=25.0)
 
-    # 2) Build all OSM segments once
-    segments = _build_segments_for_snap()
-    if not segments:
+    segs = g.snap
+    if segs.mid_tree is None:
         return SnapManyResponse(points=pts)
 
-    snapped_dense: List[SnapPoint] = []
     MAX_SNAP_DIST_M = 60.0  # max distance to snap; further = leave as is
 
-    for p in dense_pts:
-        px, py = _latlon_to_xy(p.lat, p.lon, graph_center_lat, graph_center_lon)
+    # 2) Project all points onto their candidate segments in one go, as a
+    #    flat list of (point, segment) pairs (no padding to the densest point).
+    lats = np.fromiter((p.lat for p in dense_pts), dtype=np.float64, count=len(dense_pts))
+    lons = np.fromiter((p.lon for p in dense_pts), dtype=np.float64, count=len(dense_pts))
+    px, py = latlon_to_xy(lats, lons, lat0, lon0)
 
-        best_dist = float("inf")
-        best_proj_xy: Optional[Tuple[float, float]] = None
+    # every segment that can be within MAX_SNAP_DIST_M of the point (via its pieces)
+    near = segs.mid_tree.query_ball_point(
+        np.column_stack([px, py]), r=MAX_SNAP_DIST_M + segs.max_half_len
+    )
+    counts = np.fromiter((len(n) for n in near), dtype=np.int64, count=len(near))
+    pieces = np.fromiter((i for n in near for i in n), dtype=np.int64, count=int(counts.sum()))
 
-        for (lat1, lon1, lat2, lon2) in segments:
-            x1, y1 = _latlon_to_xy(lat1, lon1, graph_center_lat, graph_center_lon)
-            x2, y2 = _latlon_to_xy(lat2, lon2, graph_center_lat, graph_center_lon)
+    # unique (point, segment) pairs, sorted by point then segment
+    n_segs = segs.x1.shape[0]
+    pair = np.unique(np.repeat(np.arange(len(dense_pts)), counts) * n_segs + segs.piece_seg[pieces])
+    row, cand = np.divmod(pair, n_segs)
 
-            proj_x, proj_y, dist = _project_point_to_segment(px, py, x1, y1, x2, y2)
+    x1, y1 = segs.x1[cand], segs.y1[cand]
+    vx, vy = segs.vx[cand], segs.vy[cand]
+    len2 = segs.len2[cand]
+    wx = px[row] - x1
+    wy = py[row] - y1
 
-            if dist < best_dist:
-                best_dist = dist
-                best_proj_xy = (proj_x, proj_y)
+    # zero-length segments project onto their start point (t = 0);
+    # float64 output so the float32 segment arrays do not cap precision
+    t = np.divide(wx * vx + wy * vy, len2, out=np.zeros(len2.shape), where=len2 > 0)
+    t = np.clip(t, 0.0, 1.0)  # clamp to segment
 
-        if best_proj_xy is None or best_dist > MAX_SNAP_DIST_M:
-            # too far from any road → keep user point
+    proj_x = x1 + t * vx
+    proj_y = y1 + t * vy
+    d2 = (px[row] - proj_x) ** 2 + (py[row] - proj_y) ** 2
+
+    # closest pair per point; the stable sort keeps ties on the lowest segment
+    order = np.lexsort((d2, row))
+    first = order[np.flatnonzero(np.diff(row[order], prepend=-1))]
+    best_dist = np.full(len(dense_pts), np.inf)
+    best_dist[row[first]] = np.sqrt(d2[first])
+    best_lat = np.empty(len(dense_pts))
+    best_lon = np.empty(len(dense_pts))
+    best_lat[row[first]], best_lon[row[first]] = xy_to_latlon(
+        proj_x[first], proj_y[first], lat0, lon0
+    )
+
+    snapped_dense: List[SnapPoint] = []
+    for i, p in enumerate(dense_pts):
+        if best_dist[i] > MAX_SNAP_DIST_M:
+            # too far from any road (or none nearby) → keep user point
             snapped_dense.append(SnapPoint(lat=p.lat, lon=p.lon))
         else:
-            proj_lat, proj_lon = _xy_to_latlon(
-                best_proj_xy[0], best_proj_xy[1],
-                graph_center_lat, graph_center_lon,
-            )
-            snapped_dense.append(SnapPoint(lat=proj_lat, lon=proj_lon))
+            snapped_dense.append(SnapPoint(lat=float(best_lat[i]), lon=float(best_lon[i])))
 
     # 3) Keep the exact start and end coordinates from the user
     if snapped_dense:
@@ -1,28 +1,28 @@
 # backend/routing.py
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import List, Optional, Dict, Tuple
-import heapq
+from typing import List, Optional, Tuple
+import os
 
-from .data import Graph, Edge
+import numpy as np
+from numba import njit
 
+from .data import GraphHot, ROAD_TYPES
 
-def edge_cost(edge: Edge) -> float:
-    """
-    Cost for scoring (not for shortest path). You can tune this.
-    """
-    base = edge.distance_m
 
-    # prefer main roads slightly
-    if edge.road_type == "main_road":
-        base *= 0.9
-    elif edge.road_type == "residential":
-        base *= 1.0
-    else:  # path
-        base *= 1.05
+# Scoring cost (not for shortest path) per meter of each road type.
+# You can tune this.
+ROAD_TYPE_COST_FACTOR = {
+    "main_road": 0.9,  # prefer main roads slightly
+    "residential": 1.0,
+    "path": 1.05,
+}
+# extra cost per meter of climb (elevation is currently 0, but this is
+# ready for real data)
+ELEVATION_COST_PER_M = 3.0
 
-    # elevation_gain_m is currently 0, but this is ready for real data
-    base += 3.0 * max(edge.elevation_gain_m, 0.0)
-    return base
+# ROAD_TYPE_COST_FACTOR indexed by GraphHot.road_type_code
+_COST_FACTOR_BY_CODE = np.array([ROAD_TYPE_COST_FACTOR[t] for t in ROAD_TYPES])
 
 
 @dataclass
@@ -33,97 +33,256 @@ class RouteResult:
     score: float  # effective score including distance penalty
 
 
-def _dijkstra(
-    graph: Graph,
-    start: str,
-    max_dist: float,
-    edge_penalty: Dict[Tuple[str, str], float] | None = None,
-) -> Tuple[Dict[str, float], Dict[str, Optional[str]]]:
+# one pool for all requests (handlers already run on FastAPI's threadpool,
+# so creating one per call only adds thread start-up cost)
+_CANDIDATE_WORKERS = os.cpu_count() or 1
+_candidate_pool = ThreadPoolExecutor(
+    max_workers=_CANDIDATE_WORKERS, thread_name_prefix="loop-candidates"
+)
+# below this many candidates, dispatch overhead outweighs the parallelism
+_MIN_PARALLEL_CANDIDATES = 8
+
+
+# "unreachable" for the integer-centimeter searches (leaves room for g + h)
+INF_CM = 1 << 62
+# width of one Dial bucket in centimeters
+BUCKET_CM = 100
+
+
+@njit(cache=True, nogil=True)
+def _dial_nb(
+    indptr: np.ndarray,
+    neighbors: np.ndarray,
+    weights_cm: np.ndarray,
+    edge_key: np.ndarray,
+    penalty_keys: np.ndarray,
+    penalty_vals: np.ndarray,
+    start_idx: int,
+    goal_idx: int,
+    h: np.ndarray,
+    max_cm: int,
+    n_buckets: int,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
-    Standard Dijkstra on edge.distance_m, with optional penalties on edges.
-    Returns:
-      dist[node] = distance from start
-      prev[node] = previous node on best path
+    Dial's algorithm (bucket queue, BUCKET_CM-wide buckets) on CSR arrays.
+
+    With h = 0 and goal_idx = -1 this is plain Dijkstra; otherwise it is A*
+    towards goal_idx. `h` must be a consistent integer lower bound
+    (INF_CM = unreachable in budget). `penalty_keys` must be sorted; the
+    factor for edge_key[j] is looked up there (default 1.0, factors must
+    be >= 1).
+
+    Edges can be shorter than a bucket, so a node popped from bucket b may
+    still improve from another node in b: it is then queued (and expanded)
+    again, and the search only stops after the goal's bucket is exhausted.
+    That keeps g exact.
+
+    Each node is queued at most once at a time (doubly linked bucket lists,
+    moved on decrease-key), so all arrays are sized by the node count.
+    Buckets are a ring of n_buckets slots (a power of two); n_buckets must
+    exceed the largest step in f // BUCKET_CM between a node and its
+    neighbor.
+    Returns (g, prev, prev_edge): g in centimeters, prev[v] the node
+    before v and prev_edge[v] the CSR position of the edge prev[v] -> v.
+    Unreached nodes have g = INF_CM and prev = prev_edge = -1.
     """
-    if edge_penalty is None:
-        edge_penalty = {}
-
-    adjacency = graph.adjacency
-    dist: Dict[str, float] = {start: 0.0}
-    prev: Dict[str, Optional[str]] = {start: None}
+    n = indptr.shape[0] - 1
+    g = np.full(n, INF_CM, dtype=np.int64)
+    prev = np.full(n, -1, dtype=np.int64)
+    prev_edge = np.full(n, -1, dtype=np.int64)
+    if h[start_idx] > max_cm:
+        return g, prev, prev_edge
+
+    # head[slot] -> first queued node; next_q / prev_q link the nodes of a
+    # bucket, slot_of[v] is v's slot (-1 = not queued)
+    head = np.full(n_buckets, -1, dtype=np.int64)
+    next_q = np.empty(n, dtype=np.int64)
+    prev_q = np.empty(n, dtype=np.int64)
+    slot_of = np.full(n, -1, dtype=np.int64)
+
+    g[start_idx] = 0
+    b = h[start_idx] // BUCKET_CM
+    mask = n_buckets - 1
+    slot = b & mask
+    next_q[start_idx] = -1
+    prev_q[start_idx] = -1
+    head[slot] = start_idx
+    slot_of[start_idx] = slot
+    live = 1
+    goal_found = False
+
+    while live > 0 and b * BUCKET_CM <= max_cm:
+        slot = b & mask
+        u = head[slot]
+        if u == -1:
+            if goal_found:
+                # goal's bucket exhausted: its g can no longer improve
+                break
+            b += 1
+            continue
 
-    heap: List[Tuple[float, str]] = [(0.0, start)]
+        # pop u
+        head[slot] = next_q[u]
+        if next_q[u] != -1:
+            prev_q[next_q[u]] = -1
+        slot_of[u] = -1
+        live -= 1
 
-    while heap:
-        d, u = heapq.heappop(heap)
-        if d > dist.get(u, float("inf")):
-            continue
-        if d > max_dist:
-            # no need to go farther: all future paths will be longer
+        if u == goal_idx:
+            goal_found = True
             continue
 
-        for e in adjacency.get(u, []):
-            v = e.v
-            base_w = e.distance_m
-            if base_w <= 0:
+        for j in range(indptr[u], indptr[u + 1]):
+            w = np.int64(weights_cm[j])
+            if w <= 0:
                 continue
 
-            key = tuple(sorted((e.u, e.v)))
-            penalty_factor = edge_penalty.get(key, 1.0)
-            w = base_w * penalty_factor
-
-            nd = d + w
-            if nd < dist.get(v, float("inf")) and nd <= max_dist:
-                dist[v] = nd
+            if penalty_keys.shape[0] > 0:
+                k = edge_key[j]
+                pos = np.searchsorted(penalty_keys, k)
+                if pos < penalty_keys.shape[0] and penalty_keys[pos] == k:
+                    w = np.int64(w * penalty_vals[pos] + 0.5)
+
+            v = np.int64(neighbors[j])
+            nd = g[u] + w
+            f = nd + h[v]
+            if nd < g[v] and f <= max_cm:
+                g[v] = nd
                 prev[v] = u
-                heapq.heappush(heap, (nd, v))
+                prev_edge[v] = j
+
+                s = slot_of[v]
+                if s != -1:
+                    # decrease-key: unlink v from its old bucket
+                    if prev_q[v] != -1:
+                        next_q[prev_q[v]] = next_q[v]
+                    else:
+                        head[s] = next_q[v]
+                    if next_q[v] != -1:
+                        prev_q[next_q[v]] = prev_q[v]
+                else:
+                    live += 1
+
+                s = (f // BUCKET_CM) & mask
+                next_q[v] = head[s]
+                prev_q[v] = -1
+                if head[s] != -1:
+                    prev_q[head[s]] = v
+                head[s] = v
+                slot_of[v] = s
+
+    return g, prev, prev_edge
+
+
+def _n_buckets(graph: GraphHot, penalty_vals: np.ndarray, max_cm: int) -> int:
+    """
+    Ring size for _dial_nb: f = g + h grows by at most w + (h(v) - h(u))
+    <= 2 * (largest penalized edge) per relaxation.
+    """
+    max_w = graph.max_weight_cm
+    max_factor = max(1.0, float(penalty_vals.max(initial=1.0)))
+    span = min(2 * int(max_w * max_factor + 0.5), max_cm) // BUCKET_CM + 2
+    # power of two so the kernel can wrap with a mask
+    return 1 << (span - 1).bit_length()
+
 
-    return dist, prev
+_NO_PENALTY_KEYS = np.empty(0, dtype=np.int32)
+_NO_PENALTY_VALS = np.empty(0, dtype=np.float64)
 
 
-def _reconstruct_path(prev: Dict[str, Optional[str]], target: str) -> Optional[List[str]]:
-    if target not in prev:
+def _dijkstra(
+    graph: GraphHot,
+    start_idx: int,
+    max_dist: float,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Standard Dijkstra on edge distances, on the CSR arrays.
+    Returns (dist_cm, prev, prev_edge) indexed by node, see _dial_nb.
+    """
+    max_cm = int(max_dist * 100)
+    return _dial_nb(
+        graph.indptr,
+        graph.neighbors,
+        graph.weights_cm,
+        graph.edge_key_id,
+        _NO_PENALTY_KEYS,
+        _NO_PENALTY_VALS,
+        start_idx,
+        -1,
+        np.zeros(len(graph.ids), dtype=np.int64),
+        max_cm,
+        _n_buckets(graph, _NO_PENALTY_VALS, max_cm),
+    )
+
+
+def _astar(
+    graph: GraphHot,
+    start_idx: int,
+    goal_idx: int,
+    max_dist: float,
+    heuristic: np.ndarray,
+    penalty_keys: np.ndarray,
+    penalty_vals: np.ndarray,
+) -> Optional[List[int]]:
+    """
+    Shortest (penalized) path start -> goal with A*, as CSR edge positions,
+    or None if it is longer than max_dist. `heuristic` is in integer
+    centimeters, indexed by node; penalties are sorted edge-key ids plus
+    parallel factors.
+    """
+    max_cm = int(max_dist * 100)
+
+    g_cm, prev, prev_edge = _dial_nb(
+        graph.indptr,
+        graph.neighbors,
+        graph.weights_cm,
+        graph.edge_key_id,
+        penalty_keys,
+        penalty_vals,
+        start_idx,
+        goal_idx,
+        heuristic,
+        max_cm,
+        _n_buckets(graph, penalty_vals, max_cm),
+    )
+    if g_cm[goal_idx] >= INF_CM:
         return None
-    path: List[str] = []
-    cur: Optional[str] = target
-    while cur is not None:
-        path.append(cur)
-        cur = prev.get(cur)
-    path.reverse()
-    return path
+    return _reconstruct_edges(prev, prev_edge, goal_idx)
 
 
-def _path_distance_and_elevation(graph: Graph, nodes: List[str]) -> Tuple[float, float, float]:
+def _reconstruct_edges(prev: np.ndarray, prev_edge: np.ndarray, target: int) -> List[int]:
     """
-    Returns (total_distance_m, total_elev_gain_m, total_cost_for_scoring)
+    CSR edge positions along the search tree path to `target`, in order.
     """
-    if len(nodes) < 2:
-        return 0.0, 0.0, 0.0
-
-    total_dist = 0.0
-    total_elev = 0.0
-    total_cost = 0.0
-
-    adjacency = graph.adjacency
-    for u, v in zip(nodes[:-1], nodes[1:]):
-        # find the edge u->v
-        edge = None
-        for e in adjacency.get(u, []):
-            if e.v == v:
-                edge = e
-                break
-        if edge is None:
-            # should not happen if graph is consistent
-            continue
-        total_dist += edge.distance_m
-        total_elev += max(edge.elevation_gain_m, 0.0)
-        total_cost += edge_cost(edge)
+    edges: List[int] = []
+    cur = target
+    while prev_edge[cur] >= 0:
+        edges.append(int(prev_edge[cur]))
+        cur = int(prev[cur])
+    edges.reverse()
+    return edges
+
+
+def _evaluate_loop(graph: GraphHot, edges: np.ndarray) -> Tuple[float, float, float, int]:
+    """
+    Single pass over the CSR edges of a path.
+    Returns (total_distance_m, total_elev_gain_m, total_cost_for_scoring,
+    reuse_count) where reuse_count is how many edges were already used
+    earlier in the path (undirected).
+    """
+    if edges.size == 0:
+        return 0.0, 0.0, 0.0, 0
+
+    dist = graph.weights[edges].astype(np.float64)
+    elev = graph.elevation_gain_dm[edges] / 10.0
+    cost = dist * _COST_FACTOR_BY_CODE[graph.road_type_code[edges]] + ELEVATION_COST_PER_M * elev
+    reuse_count = edges.size - np.unique(graph.edge_key_id[edges]).size
 
-    return total_dist, total_elev, total_cost
+    return float(dist.sum()), float(elev.sum()), float(cost.sum()), int(reuse_count)
 
 
 def find_best_loop(
-    graph: Graph,
+    graph: GraphHot,
     start: str,
     d_min_m: float,
     d_max_m: float,
@@ -137,24 +296,33 @@ def find_best_loop(
     2. Pick "far" nodes as candidate turnaround points.
     3. For each candidate v:
        - shortest path start->v
-       - shortest path v->start, but heavily penalize re-using edges from the first half
+       - shortest path v->start (A*), but heavily penalize re-using edges from the first half
     4. Combine to a loop and score by:
        - closeness to target_m
        - low elevation gain
        - low amount of repeated edges
     """
 
-    if start not in graph.nodes:
+    start_idx = graph.id_to_idx.get(start)
+    if start_idx is None:
         raise ValueError(f"Start node {start!r} not in graph")
 
     # 1) Forward Dijkstra: distances from start
-    dist_fw, prev_fw = _dijkstra(graph, start, max_dist=d_max_m)
+    dist_fw_cm, prev_fw, prev_edge_fw = _dijkstra(graph, start_idx, max_dist=d_max_m)
+
+    # Heuristic for the way back: the unpenalized distance to start. Edges
+    # are undirected and penalties only make them longer, so it is a
+    # consistent lower bound (tighter than straight-line distance), and
+    # nodes the forward search never reached are out of budget anyway.
+    h_back = dist_fw_cm
 
     # select candidate mid-points that are "far enough" but not insane
-    candidates: List[Tuple[float, str]] = []
-    for node_id, d in dist_fw.items():
-        if d_min_m * 0.4 <= d <= target_m:  # tweakable range
-            candidates.append((d, node_id))
+    dist_fw = dist_fw_cm / 100.0
+    in_range = (dist_fw_cm < INF_CM) & (d_min_m * 0.4 <= dist_fw) & (dist_fw <= target_m)
+    ids = graph.ids
+    candidates: List[Tuple[float, str, int]] = [
+        (float(dist_fw[i]), ids[i], i) for i in np.flatnonzero(in_range).tolist()
+    ]
 
     if not candidates:
         return None
@@ -162,84 +330,72 @@ def find_best_loop(
     # sort so we try farther nodes first
     candidates.sort(reverse=True)
 
-    best: Optional[RouteResult] = None
-
     # limit how many midpoints we test to keep it fast
     MAX_CANDIDATES = 40
     candidates = candidates[:MAX_CANDIDATES]
 
-    for dist_to_v, v in candidates:
-        # 2) reconstruct start -> v
-        path_fw = _reconstruct_path(prev_fw, v)
-        if not path_fw or len(path_fw) < 2:
-            continue
+    def run_one_candidate(candidate: Tuple[float, str, int]) -> Optional[RouteResult]:
+        dist_to_v, _, v = candidate
 
+        # 2) reconstruct start -> v
+        edges_fw = _reconstruct_edges(prev_fw, prev_edge_fw, v)
+        if not edges_fw:
+            return None
 
-        # build set of edges used in forward path (undirected)
-        used_edges: Dict[Tuple[str, str], int] = {}
-        for u, w in zip(path_fw[:-1], path_fw[1:]):
-            key = tuple(sorted((u, w)))
-            used_edges[key] = used_edges.get(key, 0) + 1
+        # edges used in forward path (undirected), as sorted edge-key ids
+        used_keys = np.unique(graph.edge_key_id[edges_fw])
 
         # penalty: heavily discourage re-using same edges on the way back
-        edge_penalty: Dict[Tuple[str, str], float] = {
-            key: 4.0 for key in used_edges.keys()
-        }
+        penalty_vals = np.full(used_keys.shape[0], 4.0)
 
         remaining_dist_budget = d_max_m - dist_to_v
         if remaining_dist_budget <= 0:
-            continue
+            return None
 
-        # 3) Dijkstra from v back towards start, with penalties
-        dist_back, prev_back = _dijkstra(
+        # 3) A* from v back to start, with penalties (kernel releases the GIL)
+        edges_back = _astar(
             graph,
-            start=v,
+            start_idx=v,
+            goal_idx=start_idx,
             max_dist=remaining_dist_budget,
-            edge_penalty=edge_penalty,
+            heuristic=h_back,
+            penalty_keys=used_keys,
+            penalty_vals=penalty_vals,
         )
-
-        if start not in dist_back:
+        if not edges_back:
             # no path back within remaining distance
-            continue
-
-        path_back = _reconstruct_path(prev_back, start)
-        if not path_back or len(path_back) < 2:
-            continue
+            return None
 
         # combine paths into loop: start -> v -> ... -> start
-        # path_fw: [start, ..., v]
-        # path_back: [v, ..., start]
-        loop_nodes = path_fw + path_back[1:]  # avoid duplicating v
+        loop_edges = np.array(edges_fw + edges_back, dtype=np.int64)
 
-        total_dist, total_elev, total_cost = _path_distance_and_elevation(
-            graph, loop_nodes
+        total_dist, total_elev, total_cost, reuse_count = _evaluate_loop(
+            graph, loop_edges
         )
 
         if total_dist < d_min_m or total_dist > d_max_m:
-            continue
+            return None
         if total_elev > elev_limit_m:
-            continue
-
-        # measure how many edges were reused
-        reuse_count = 0
-        seen_edges = set()
-        for u, w in zip(loop_nodes[:-1], loop_nodes[1:]):
-            key = tuple(sorted((u, w)))
-            if key in seen_edges:
-                reuse_count += 1
-            else:
-                seen_edges.add(key)
+            return None
 
         # score: closeness to target + penalty for re-use
         deviation = abs(total_dist - target_m)
         score = total_cost + 5.0 * (deviation ** 2) + 300.0 * reuse_count
 
-        if best is None or score < best.score:
-            best = RouteResult(
-                nodes=loop_nodes,
-                distance_m=total_dist,
-                elevation_gain_m=total_elev,
-                score=score,
-            )
+        loop_nodes = [ids[start_idx]] + [ids[i] for i in graph.neighbors[loop_edges].tolist()]
+        return RouteResult(
+            nodes=loop_nodes,
+            distance_m=total_dist,
+            elevation_gain_m=total_elev,
+            score=score,
+        )
+
+    # candidates are independent: run them in parallel when it pays off
+    if _CANDIDATE_WORKERS > 1 and len(candidates) >= _MIN_PARALLEL_CANDIDATES:
+        results_iter = _candidate_pool.map(run_one_candidate, candidates)
+    else:
+        results_iter = map(run_one_candidate, candidates)
+    results = [r for r in results_iter if r is not None]
 
-    return best
+    # min() keeps the first of equal scores, i.e. the farthest candidate
+    return min(results, key=lambda r: r.score, default=None)
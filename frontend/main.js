@@ -192,14 +192,14 @@ function drawRoadNetwork() {
     .then((segments) => {
       console.log("Got segments from /graph:", segments.length);
 
-      segments.forEach((seg) => {
+      segments.forEach(([lat1, lon1, lat2, lon2, roadType]) => {
         let color;
         let weight;
 
-        if (seg.road_type === "main_road") {
+        if (roadType === "main_road") {
           color = "#ff0000"; // BRIGHT RED, impossible to miss
           weight = 6;
-        } else if (seg.road_type === "residential") {
+        } else if (roadType === "residential") {
           color = "#0000ff"; // BRIGHT BLUE
           weight = 4;
         } else {
@@ -209,8 +209,8 @@ function drawRoadNetwork() {
 
         L.polyline(
           [
-            [seg.lat1, seg.lon1],
-            [seg.lat2, seg.lon2],
+            [lat1, lon1],
+            [lat2, lon2],
           ],
           {
             color,